@@ -12,7 +12,9 @@ import time
 import random
 import tempfile
 import re
-from decimal import Decimal
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from numba import njit, prange
 
 
 # Our source data includes letters, numbers, and punctuation - all ascii
@@ -23,13 +25,28 @@ CHARACTERS = " " + string.digits + string.ascii_letters + string.punctuation
 CLASSES = len(CHARACTERS) + 1
 
 CHAR_TO_INDEX = {c: i for i, c in enumerate(CHARACTERS)}
-INDEX_TO_CHAR = {i: c for i, c in enumerate(CHARACTERS)}
+INDEX_TO_CHAR = np.array(list(CHARACTERS))
+
+# Every class index fits in a byte, so we can encode with a single `bytes.translate`
+_UNKNOWN_CHAR = 255
+_ENCODE_TABLE = bytes(CHAR_TO_INDEX.get(chr(b), _UNKNOWN_CHAR) for b in range(256))
 
 def encode_string(string):
-    return np.array([CHAR_TO_INDEX[c] for c in string], dtype='int32')
+    encoded = np.frombuffer(string.encode('ascii').translate(_ENCODE_TABLE), dtype='uint8')
+    if (encoded == _UNKNOWN_CHAR).any():
+        raise ValueError(f"Unexpected character in `{string}`")
+    return encoded.astype('int32')
 
 def decode_string(string):
-    return "".join(INDEX_TO_CHAR[c] for c in string if c != -1)
+    string = np.asarray(string, dtype='int32')
+    return "".join(INDEX_TO_CHAR[string[string != -1]])
+
+# Both point formats only use these as separators, so we can parse either with a single space
+_POINT_SEPARATORS = str.maketrans(";,", "  ")
+
+def parse_points(text, big_sep, small_sep):
+    width = text.split(big_sep, 1)[0].count(small_sep) + 1
+    return np.fromstring(text.translate(_POINT_SEPARATORS), sep=" ", dtype='float32').reshape(-1, width)
 
 def load_tensors(test_file):
     with tf.io.gfile.GFile(test_file) as f:
@@ -45,8 +62,8 @@ def load_tensors(test_file):
         else:
             (big_sep, small_sep) = (",", " ")
 
-        points = [[float(n) for n in p.split(small_sep)] for p in text_and_points[1].split(big_sep)]
-        result.append((text, np.array(points, dtype='float32')))
+        points = parse_points(text_and_points[1], big_sep, small_sep)
+        result.append((text, points))
     return result
 
 def save_tensors(pairs, path):
@@ -66,13 +83,7 @@ def load_inks(filename):
         text_and_points = line.split("\t")
         assert len(text_and_points) == 2, line
         text = text_and_points[0]
-        strokes = [
-            np.array([
-                [float(n) for n in p.split(" ")]
-                for p in s.split(",")
-            ], dtype='float32')
-            for s in text_and_points[1].split(";")
-        ]
+        strokes = [parse_points(s, ",", " ") for s in text_and_points[1].split(";")]
         result.append((text, strokes))
     return result
 
@@ -84,49 +95,211 @@ def save_inks(pairs, filename):
             f.write(";".join(",".join(" ".join(f'{a:.3f}' for a in p) for p in s) for s in points))
             f.write("\n")
 
+@njit(cache=True, fastmath=True)
+def _lev_bitparallel(a_bytes, b_bytes, peq, vectors):
+    # Myers / Hyyrö bit-parallel edit distance: each bit of a word tracks the
+    # vertical delta for one row of the DP table, so a word covers 64 rows.
+    # Longer strings are split into 64-row blocks, with the horizontal delta
+    # at the bottom of each block carried into the top of the next.
+    m = len(a_bytes)
+    if m == 0:
+        return len(b_bytes)
+
+    zero = np.uint64(0)
+    one = np.uint64(1)
+    top_bit = np.uint64(63)
+    blocks = (m + 63) // 64
+    last_bit = np.uint64((m - 1) % 64)
+
+    # `peq` is all zeroes on the way in, and we clear the bits we set before returning
+    for i in range(m):
+        peq[a_bytes[i], i // 64] |= one << np.uint64(i % 64)
+
+    vp = vectors[0]
+    vn = vectors[1]
+    vp[:blocks] = ~zero
+    vn[:blocks] = zero
+    score = m
+
+    for j in range(len(b_bytes)):
+        c = b_bytes[j]
+        # The top row of the table is 0, 1, 2, ... so it always steps up by one
+        h_in = 1
+        for k in range(blocks):
+            eq = peq[c, k]
+            p = vp[k]
+            n = vn[k]
+            x = eq | n
+            if h_in < 0:
+                eq |= one
+            d0 = (((eq & p) + p) ^ p) | eq
+            hp = n | ~(d0 | p)
+            hn = p & d0
+
+            high = last_bit if k == blocks - 1 else top_bit
+            h_out = 0
+            if (hp >> high) & one:
+                h_out = 1
+            elif (hn >> high) & one:
+                h_out = -1
+
+            hp <<= one
+            hn <<= one
+            if h_in < 0:
+                hn |= one
+            elif h_in > 0:
+                hp |= one
+
+            vp[k] = hn | ~(x | hp)
+            vn[k] = hp & x
+            h_in = h_out
+        score += h_in
+
+    for i in range(m):
+        peq[a_bytes[i], i // 64] = zero
+
+    return score
+
+# Scratch space for `_lev_bitparallel`, kept between calls and grown as needed
+_LEV_PEQ = np.zeros((256, 0), dtype='uint64')
+_LEV_VECTORS = np.zeros((2, 0), dtype='uint64')
+
 def levenstein(a, b):
-    len_a, len_b = len(a)+1, len(b)+1
-    matrix = np.zeros(shape=(len_a, len_b), dtype='int32')
-    matrix[:,0] = np.arange(len_a)
-    matrix[0,:] = np.arange(len_b)
-    for a_i, a_c in zip(range(1, len_a), a):
-        for b_i, b_c in zip(range(1, len_b), b):
-            if a_c == b_c:
-                matrix[a_i, b_i] = matrix[a_i-1, b_i-1]
-            else:
-                matrix[a_i, b_i] = 1 + min(matrix[a_i-1, b_i-1], matrix[a_i, b_i-1], matrix[a_i-1, b_i])
-    return matrix[-1, -1]
+    global _LEV_PEQ, _LEV_VECTORS
+    # Put the shorter string down the side of the table, so it needs fewer words
+    if len(a) > len(b):
+        a, b = b, a
+    a_bytes = np.frombuffer(a.encode(), dtype='uint8')
+    b_bytes = np.frombuffer(b.encode(), dtype='uint8')
+
+    blocks = (len(a_bytes) + 63) // 64
+    if _LEV_PEQ.shape[1] < blocks:
+        _LEV_PEQ = np.zeros((256, blocks * 2), dtype='uint64')
+        _LEV_VECTORS = np.zeros((2, blocks * 2), dtype='uint64')
+    return _lev_bitparallel(a_bytes, b_bytes, _LEV_PEQ, _LEV_VECTORS)
 
 def cer(pred, true):
     return levenstein(pred, true) / len(true)
 
 def dataset_from_pairs(pairs):
     """
-    Accepts string->[N,4]d tensor pairs and returs a dataset
+    Accepts string->[N,W]d tensor pairs and returns an (unbatched) dataset
     """
     pairs = list(pairs)
-    lines_tensor = tf.ragged.constant([encode_string(p[0]) for p in pairs])
-    inks_tensor = tf.ragged.constant([p[1] for p in pairs], dtype=tf.float32)
-
-    return tf.data.Dataset.from_tensor_slices({
-        "lines": lines_tensor.to_tensor(),
-        "line_lengths": tf.reshape(lines_tensor.row_lengths(), (-1, 1)),
-        "inks": inks_tensor.to_tensor(),
-        "ink_lengths": tf.reshape(inks_tensor.row_lengths(), (-1, 1)),
+    # Tensor files can be 4 wide (splines) or 10 wide (beziers)
+    width = pairs[0][1].shape[1] if pairs else None
+
+    def generate():
+        for (line, points) in pairs:
+            yield {
+                "lines": encode_string(line),
+                "line_lengths": [len(line)],
+                "inks": points,
+                "ink_lengths": [len(points)],
+            }
+
+    return tf.data.Dataset.from_generator(generate, output_signature={
+        "lines": tf.TensorSpec(shape=(None,), dtype=tf.int32),
+        "line_lengths": tf.TensorSpec(shape=(1,), dtype=tf.int64),
+        "inks": tf.TensorSpec(shape=(None, width), dtype=tf.float32),
+        "ink_lengths": tf.TensorSpec(shape=(1,), dtype=tf.int64),
     })
 
+def save_tfrecord(pairs, path):
+    """
+    Writes string->[N,W]d tensor pairs as a TFRecord file, so training can stream
+    them back without reparsing the text format every run
+    """
+    with tf.io.TFRecordWriter(path) as writer:
+        for (line, points) in pairs:
+            example = tf.train.Example(features=tf.train.Features(feature={
+                "lines": tf.train.Feature(int64_list=tf.train.Int64List(value=encode_string(line))),
+                "inks": tf.train.Feature(bytes_list=tf.train.BytesList(value=[points.astype('float32').tobytes()])),
+                "ink_width": tf.train.Feature(int64_list=tf.train.Int64List(value=[points.shape[1]])),
+            }))
+            writer.write(example.SerializeToString())
+
+def parse_example(serialized):
+    features = tf.io.parse_single_example(serialized, {
+        "lines": tf.io.VarLenFeature(tf.int64),
+        "inks": tf.io.FixedLenFeature([], tf.string),
+        "ink_width": tf.io.FixedLenFeature([], tf.int64),
+    })
+    lines = tf.cast(tf.sparse.to_dense(features["lines"]), tf.int32)
+    # Tensor files can be 4 wide (splines) or 10 wide (beziers)
+    inks = tf.reshape(tf.io.decode_raw(features["inks"], tf.float32), tf.stack([-1, features["ink_width"]]))
+    return {
+        "lines": lines,
+        "line_lengths": tf.shape(lines, out_type=tf.int64)[:1],
+        "inks": inks,
+        "ink_lengths": tf.shape(inks, out_type=tf.int64)[:1],
+    }
+
+def load_tfrecord(path):
+    """
+    Streams a file written by `save_tfrecord` as an (unbatched) dataset
+    """
+    return tf.data.TFRecordDataset(path, num_parallel_reads=tf.data.AUTOTUNE) \
+        .map(parse_example, num_parallel_calls=tf.data.AUTOTUNE)
+
+@tf.function(input_signature=[
+    tf.TensorSpec(shape=(None, None, CLASSES), dtype=tf.float32),
+    tf.TensorSpec(shape=(None, 1), dtype=tf.int64),
+])
+def ctc_greedy_decode(predicted_labels, predicted_lengths):
+    # Same log-probabilities that `keras.backend.ctc_decode` would feed the decoder
+    logits = tf.math.log(tf.transpose(predicted_labels, [1, 0, 2]) + keras.backend.epsilon())
+    decoded, _ = tf.nn.ctc_greedy_decoder(logits, tf.cast(tf.squeeze(predicted_lengths, axis=1), tf.int32))
+    return tf.sparse.to_dense(decoded[0], default_value=-1)
+
 def ctc_decode(predicted_labels, predicted_lengths, beam_width=1):
-    decoded, probabilities = keras.backend.ctc_decode(
-        predicted_labels,
-        tf.squeeze(predicted_lengths, axis=1),
-        greedy=(beam_width == 1),
-        beam_width=beam_width,
-    )
-    return [decode_string(l) for l in decoded[0].numpy().tolist()]
+    if beam_width == 1:
+        decoded = ctc_greedy_decode(predicted_labels, predicted_lengths)
+    else:
+        decoded, probabilities = keras.backend.ctc_decode(
+            predicted_labels,
+            tf.squeeze(predicted_lengths, axis=1),
+            greedy=False,
+            beam_width=beam_width,
+        )
+        decoded = decoded[0]
+    return [decode_string(l) for l in decoded.numpy()]
 
+@tf.function
 def ctc_loss(true_labels, true_lengths, predicted_labels, predicted_lengths):
-    # Yes, the order is weird, but correct.
-    return keras.backend.ctc_batch_cost(true_labels, predicted_labels, predicted_lengths, true_lengths)
+    labels = tf.RaggedTensor.from_tensor(
+        tf.cast(true_labels, tf.int32),
+        lengths=tf.cast(tf.squeeze(true_lengths, axis=1), tf.int64),
+    ).to_sparse()
+    # The model outputs probabilities, but their logs work just as well as logits
+    logits = tf.math.log(tf.transpose(predicted_labels, [1, 0, 2]) + keras.backend.epsilon())
+    loss = tf.nn.ctc_loss(
+        labels=labels,
+        logits=logits,
+        label_length=None,
+        logit_length=tf.cast(tf.squeeze(predicted_lengths, axis=1), tf.int32),
+        logits_time_major=True,
+        blank_index=CLASSES - 1,
+    )
+    # Keep the [batch, 1] shape that `ctc_batch_cost` used to return
+    return tf.expand_dims(loss, 1)
+
+def load_ondb_strokes(xml_path):
+    """
+    Streams the strokes out of an IAM-OnDB line file as [N,3]d float64 arrays.
+    (Raw timestamps need the extra precision until they're offset.)
+    """
+    ink = []
+    points = []
+    for _, element in ElementTree.iterparse(xml_path):
+        if element.tag == "Point":
+            points.append((float(element.attrib['x']), float(element.attrib['y']), float(element.attrib['time'])))
+            element.clear()
+        elif element.tag == "Stroke":
+            ink.append(np.array(points, dtype='float64').reshape(-1, 3))
+            points = []
+            element.clear()
+    return ink
 
 def load_ondb(data_dir, name):
     BAD_DATA = [
@@ -151,63 +324,67 @@ def load_ondb(data_dir, name):
     with open(os.path.join(data_dir, f"{name}.txt")) as f:
         training_set = [t.strip() for t in f.readlines()]
 
-    result = []
+    ascii_files = []
     for ascii_file in training_set:
         if ascii_file in BAD_DATA:
             print("Discarding: ", ascii_file)
             continue
+        ascii_files.append(ascii_file)
 
-        relative_dir = os.path.join(ascii_file[:3], ascii_file[:7])
-        ascii_path = os.path.join(data_dir, "ascii", relative_dir, ascii_file + ".txt")
-
-        with open(ascii_path) as f:
-            ascii_lines = [t.strip() for t in f.readlines()]
+    # Each file parses independently, so spread them over all our cores
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(functools.partial(load_ondb_file, data_dir), ascii_files, chunksize=8)
+        return [pair for result in results for pair in result]
 
-        csr_index = ascii_lines.index("CSR:")
-        ascii_lines = ascii_lines[csr_index+2:]
+def load_ondb_file(data_dir, ascii_file):
+    relative_dir = os.path.join(ascii_file[:3], ascii_file[:7])
+    ascii_path = os.path.join(data_dir, "ascii", relative_dir, ascii_file + ".txt")
 
-        for i, line in enumerate(ascii_lines):
-            xml_path = os.path.join(data_dir, "lineStrokes", relative_dir, f"{ascii_file}-{i+1:02d}.xml")
-            xml = ElementTree.parse(xml_path)
-            ink = []
-            for stroke in xml.findall("./StrokeSet/Stroke"):
-                points = []
-                for point in stroke.findall("./Point"):
-                    x = float(point.attrib['x'])
-                    y = float(point.attrib['y'])
-                    t = Decimal(point.attrib['time'])
-                    points.append(np.asarray([x, y, t]))
+    with open(ascii_path) as f:
+        ascii_lines = [t.strip() for t in f.readlines()]
 
-                ink.append(points)
+    csr_index = ascii_lines.index("CSR:")
+    ascii_lines = ascii_lines[csr_index+2:]
 
-            min_t = min(x[2] for stroke in ink for x in stroke)
+    result = []
+    for i, line in enumerate(ascii_lines):
+        xml_path = os.path.join(data_dir, "lineStrokes", relative_dir, f"{ascii_file}-{i+1:02d}.xml")
+        ink = load_ondb_strokes(xml_path)
 
-            # We mostly normalize elsewhere, but `t` can readily overflow a 32-bit float
-            for stroke in ink:
-                for p in stroke:
-                    p[2] = float(p[2] - min_t)
+        # We mostly normalize elsewhere, but `t` can readily overflow a 32-bit float
+        min_t = np.concatenate([s[:, 2] for s in ink]).min()
+        for stroke in ink:
+            stroke[:, 2] -= min_t
 
-            line = clean_iam_text(line)
+        line = clean_iam_text(line)
 
-            result.append((line, [np.array(s, dtype='float32') for s in ink]))
+        result.append((line, [s.astype('float32') for s in ink]))
 
     return result
 
 
+_IAM_REPLACEMENTS = {
+    ",,": "\"",
+    "`": "'",
+    " ,": ",",
+    " .": ".",
+    " !": "!",
+    " ?": "?",
+    " )": ")",
+    "( ": "(",
+    " :": ":",
+    "n ' t": "n't",
+    "n ` t": "n't",
+    " ' s": "'s",
+    " ` s": "'s",
+}
+# Patterns that could overlap are written to match the same text a chain of `str.replace`s would:
+# backticks count as quotes in the contractions, and ` ' s ` only matches if its trailing space
+# wouldn't have already been consumed by the punctuation fixups.
+_IAM_PATTERN = re.compile(r",,|`| ,(?!,)| \.| !| \?| \)|\( | :|n ['`] t| ['`] s(?= (?!,(?!,)|[.!?):]))")
+
 def clean_iam_text(line):
-    after = (
-        line.replace(",,", "\"")
-            .replace("`", "'")
-            .replace(" ,", ",")
-            .replace(" .", ".")
-            .replace(" !", "!")
-            .replace(" ?", "?")
-            .replace(" )", ")")
-            .replace("( ", "(")
-            .replace(" :", ":")
-            .replace("n ' t", "n't")
-            .replace(" ' s ", "'s ")
-    )
+    after = _IAM_PATTERN.sub(lambda m: _IAM_REPLACEMENTS[m.group()], line)
     if after.startswith("\" "):
         after = "\"" + after[2:]
     if after.endswith(" \""):
@@ -221,38 +398,53 @@ def clean_iam_text(line):
     return after
 
 
-def normalize(pairs):
-    results = []
-    for line, array in pairs:
-        ink = list(array)
+@njit(cache=True)
+def _fix_time(t, last_time):
+    # fix up time axis: remove reversals or big jumps
+    pauses = 0.0
+    for i in range(len(t)):
+        # correct for pauses
+        current_time = t[i] - pauses
+
+        # expect time to be monotonic!
+        current_time = max(current_time, last_time)
 
-        # fix up time axis: remove reversals or big jumps
-        last_time = ink[0][3]
-        pauses = 0.0
-        for i in ink:
-            current_time = i[2]
+        # if paused for over half a second, subtract that out and add to the pause counter
+        max_time = last_time + 0.5
+        if max_time > current_time:
+            pauses = pauses + (current_time - max_time)
+            current_time = max_time
 
-            # correct for pauses
-            current_time = current_time - pauses
+        t[i] = last_time = current_time
 
-            # expect time to be monotonic!
-            current_time = max(current_time, last_time)
 
-            # if paused for over half a second, subtract that out and add to the pause counter
-            max_time = last_time + 0.5
-            if max_time > current_time:
-                pauses = pauses + (current_time - max_time)
-                current_time = max_time
+@njit(cache=True)
+def _downsample(ink):
+    # Downsample: ignore points that are close to the previous point
+    kept = np.empty(len(ink) + 1, dtype=np.int64)
+    kept[0] = 0
+    count = 1
+    for i in range(len(ink)):
+        last = ink[kept[count - 1]]
+        # NB: never skip the last point in the line!
+        if ink[i, 3] < 0.0 or (last[0] - ink[i, 0]) ** 2 + (last[1] - ink[i, 1]) ** 2 > 0.0025:
+            kept[count] = i
+            count += 1
+    return kept[:count]
 
-            i[2] = last_time = current_time
+
+def normalize(pairs):
+    results = []
+    for line, array in pairs:
+        ink = np.array(array)
+
+        _fix_time(ink[:, 2], ink[0, 3])
 
         # normalize ink
-        min_x = min([i[0] for i in ink])
-        max_x = max([i[0] for i in ink])
-        min_y = min([i[1] for i in ink])
-        max_y = max([i[1] for i in ink])
-        min_t = ink[0][2]
-        max_t = ink[-1][2]
+        min_x, min_y = ink[:, 0].min(), ink[:, 1].min()
+        max_x, max_y = ink[:, 0].max(), ink[:, 1].max()
+        min_t = ink[0, 2]
+        max_t = ink[-1, 2]
 
         if max_y == min_y:
             print("Skipping: ", line)
@@ -264,131 +456,119 @@ def normalize(pairs):
         time_scale = scale * (max_x - min_x) / (max_t - min_t)
 
         # perform the scale normalization!
-        for i in ink:
-            i[0] = (i[0] - min_x) * scale
-            i[1] = (i[1] - min_y) * scale
-            i[2] = (i[2] - min_t) * time_scale
-
-        # Downsample: ignore points that are close to the previous point
-        sampled = [ink[0]]
-        for i in ink:
-            last = sampled[-1]
-            # NB: never skip the last point in the line!
-            if i[3] < 0.0 or (last[0] - i[0]) ** 2 + (last[1] - i[1]) ** 2 > 0.0025:
-                sampled.append(i)
-        ink = sampled
-
-        results.append((line, np.array(ink)))
+        ink[:, 0:2] -= [min_x, min_y]
+        ink[:, 0:2] *= scale
+        ink[:, 2] -= min_t
+        ink[:, 2] *= time_scale
+
+        results.append((line, ink[_downsample(ink)]))
 
     return results
 
 
+_TRACE_NUMBER_PATTERN = re.compile(r'-?(?:[0-9]+\.?[0-9]*|\.[0-9]+)')
+
 def load_docdb(data_dir, name, data_type):
     with open(os.path.join(data_dir, name)) as f:
         files = [t.strip() for t in f.readlines()]
 
+    # 856a is specified in set 4 but doesn't seem to exist
+    # 024 and 227 have vertical text in a way we don't care to support
+    files = [file for file in files if file not in ['856a.inkml', '024.inkml', '227.inkml']]
+
+    # Each file parses independently, so spread them over all our cores
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(functools.partial(load_docdb_file, data_dir, data_type), files, chunksize=8)
+        return [pair for result in results for pair in result]
+
+def load_docdb_file(data_dir, data_type, file):
     results = []
-    for file in files:
-        # 856a is specified in set 4 but doesn't seem to exist
-        # 024 and 227 have vertical text in a way we don't care to support
-        if file in ['856a.inkml', '024.inkml', '227.inkml']:
-            continue
-        tree = ElementTree.parse(os.path.join(data_dir, file))
-
-        mapping = tree.find(".//mapping")
-        mapping_type = mapping.attrib['type']
-        if mapping_type == 'identity':
-            transform = np.identity(3)
-        elif mapping_type == 'affine':
-            transform = np.transpose(np.array([
-                [float(f) for f in line.split(" ")]
-                for line
-                in mapping.find(".//matrix").text.split(",")[:-1]
-            ])[:3, :3])
-        else:
-            print("Unexpected mapping type ", mapping_type, " in file ", file)
-            continue
+    tree = ElementTree.parse(os.path.join(data_dir, file))
+
+    mapping = tree.find(".//mapping")
+    mapping_type = mapping.attrib['type']
+    if mapping_type == 'identity':
+        transform = np.identity(3)
+    elif mapping_type == 'affine':
+        transform = np.transpose(np.array([
+            [float(f) for f in line.split(" ")]
+            for line
+            in mapping.find(".//matrix").text.split(",")[:-1]
+        ])[:3, :3])
+    else:
+        print("Unexpected mapping type ", mapping_type, " in file ", file)
+        return []
+
+    traces = tree.findall("./trace")
 
-        traces = tree.findall("./trace")
+    def parse_trace_string(text):
+        # NB: we assume the usual pattern of pos, velocity, accel, accel...
+        # because it's really annoying to parse out the actual sigils.
+        numbers = np.array([
+            [float(n) for n in _TRACE_NUMBER_PATTERN.findall(line)][:3]
+            for line in text.split(",")
+        ])
 
-        def parse_trace_string(text):
-            # NB: we assume the usual pattern of pos, velocity, accel, accel...
-            # because it's really annoying to parse out the actual sigils.
-            numbers = [
-                [float(n) for n in re.findall(r'-?[0-9]*\.?[0-9]*', line) if n][:3]
-                for line in text.split(",")
+        # Velocities are the running sum of the accelerations, and positions of the velocities
+        velocities = np.cumsum(numbers[1:], axis=0)
+        points = np.concatenate([numbers[:1], numbers[0] + np.cumsum(velocities, axis=0)])
+        return points.dot(transform)
+
+    id_to_trace = {
+        trace.attrib['{http://www.w3.org/XML/1998/namespace}id']: parse_trace_string(trace.text)
+        for trace in traces
+    }
+
+    def nodes_of_type(root, type):
+        results = []
+        for view in root.findall(".//traceView"):
+            annotation = view.find('./annotation')
+            if annotation is None:
+                continue
+            if annotation.text == type:
+                results.append(view)
+        return results
+
+    wrapper_type, node_type = {
+        'lines': ('Textblock', 'Textline'),
+        'words': ('Textblock', 'Word'),
+        'table': ('Table', 'Textline'),
+    }[data_type]
+
+    for textblock in nodes_of_type(tree, wrapper_type):
+        for textline in nodes_of_type(textblock, node_type):
+            transcription = textline[1].text
+
+            if transcription is None:
+                continue
+
+            transcription = transcription.strip()
+            transcription = transcription.replace("´", "'")
+
+            if transcription == "" or "<Symbol/>" in transcription or transcription in " .,-'\"":
+                continue
+
+            if any(c not in CHARACTERS for c in transcription):
+                print(f"Invalid character in `{transcription}`")
+                continue
+
+            traces = [
+                trace.attrib['traceDataRef'][1:]
+                for trace
+                in textline.findall('.//traceView[@traceDataRef]')
             ]
+            ink = [id_to_trace[t] for t in traces]
+
+            min_t = ink[0][0, 2]
+            for stroke in ink:
+                stroke[:, 2] -= min_t
+            assert ink[0][0, 2] == 0.0
+
+            if len(ink) == 0:
+                continue
+
+            results.append((clean_iam_text(transcription), ink))
 
-            points = []
-            arrays = list(np.array(numbers))
-            position = arrays[0]
-            points.append(position)
-            if len(arrays) > 1:
-                velocity = arrays[1]
-                position = position + velocity
-                points.append(position)
-                for acceleration in arrays[2:]:
-                    velocity = velocity + acceleration
-                    position = position + velocity
-                    points.append(position)
-
-            array = np.array(points)
-            return array.dot(transform)
-
-        id_to_trace = {
-            trace.attrib['{http://www.w3.org/XML/1998/namespace}id']: parse_trace_string(trace.text)
-            for trace in traces
-        }
-
-        def nodes_of_type(root, type):
-            results = []
-            for view in root.findall(".//traceView"):
-                annotation = view.find('./annotation')
-                if annotation is None:
-                    continue
-                if annotation.text == type:
-                    results.append(view)
-            return results
-
-        wrapper_type, node_type = {
-            'lines': ('Textblock', 'Textline'),
-            'words': ('Textblock', 'Word'),
-            'table': ('Table', 'Textline'),
-        }[data_type]
-
-        for textblock in nodes_of_type(tree, wrapper_type):
-            for textline in nodes_of_type(textblock, node_type):
-                transcription = textline[1].text
-
-                if transcription is None:
-                    continue
-
-                transcription = transcription.strip()
-                transcription = transcription.replace("´", "'")
-
-                if transcription == "" or "<Symbol/>" in transcription or transcription in " .,-'\"":
-                    continue
-
-                if any(c not in CHARACTERS for c in transcription):
-                    print(f"Invalid character in `{transcription}`")
-                    continue
-
-                traces = [
-                    trace.attrib['traceDataRef'][1:]
-                    for trace
-                    in textline.findall('.//traceView[@traceDataRef]')
-                ]
-                ink = [id_to_trace[t] for t in traces]
-
-                min_t = ink[0][0, 2]
-                for stroke in ink:
-                    stroke[:, 2] -= min_t
-                assert ink[0][0, 2] == 0.0
-
-                if len(ink) == 0:
-                    continue
-
-                results.append((clean_iam_text(transcription), ink))
 
     return results
 
@@ -399,14 +579,15 @@ def is_invalid(text, ink):
     if not ink:
         return "Empty ink"
 
-    last_time = ink[0][0,2]
-    for stroke in ink:
-        for t in stroke[:, 2]:
-            if t < last_time:
-                return f"Time goes backwards! {last_time} -> {t}"
-            if t > last_time + 8.0:
-                return f"Implausibly long wait between samples! {last_time} -> {t}"
-            last_time = t
+    times = np.concatenate([stroke[:, 2] for stroke in ink])
+    gaps = np.diff(times)
+    bad = (gaps < 0.0) | (gaps > 8.0)
+    if bad.any():
+        i = bad.argmax()
+        last_time, t = times[i], times[i + 1]
+        if t < last_time:
+            return f"Time goes backwards! {last_time} -> {t}"
+        return f"Implausibly long wait between samples! {last_time} -> {t}"
 
     if ' " ' in text or " ' " in text:
         return f"Suspiciously spaced quote in text: `{text}`"
@@ -448,27 +629,47 @@ def augment(pairs, subset, target_size):
 
     def transform(strokes):
         j = 0.1
-        matrix = np.array([
-            [u(1-j, 1+j),   0.0,            0.0],
-            [u(-j*2, j*2),  u(1-j, 1+j),    0.0],
-            [0.0,           0.0,            u(1-j, 1+j)],
-        ])
-        return [np.matmul(stroke, matrix) for stroke in strokes]
+        matrix = np.zeros((3, 3))
+        matrix[0, 0] = u(1-j, 1+j)
+        matrix[1, 0] = u(-j*2, j*2)
+        matrix[1, 1] = u(1-j, 1+j)
+        matrix[2, 2] = u(1-j, 1+j)
+
+        # One matmul over all the strokes at once, then split them back up
+        splits = np.cumsum([len(stroke) for stroke in strokes])[:-1]
+        return np.split(np.concatenate(strokes) @ matrix, splits)
 
     output = pairs.copy()
     for line, strokes in itertools.islice(itertools.cycle(pairs), target_size - len(pairs)):
         output.append((line, transform(strokes)))
     return output
 
+@njit(parallel=True, cache=True)
+def _to_deltas(points, row_starts):
+    deltas = np.empty_like(points)
+    for i in prange(len(points)):
+        deltas[i, 3:] = points[i, 3:]
+        if row_starts[i]:
+            deltas[i, :3] = 0.0
+        else:
+            # subtract the point immediately before each point to get the delta
+            deltas[i, :3] = points[i, :3] - points[i-1, :3]
+    return deltas
+
 def to_deltas(pairs):
-    results = []
-    for (line, array) in pairs:
-        updated = np.copy(array)
-        # subtract the point immediately before each point to get the delta
-        updated[1:, :3] = array[1:, :3] - array[:-1, :3]
-        updated[0, :3] = 0.0
-        results.append((line, updated))
-    return results
+    if not pairs:
+        return []
+
+    # Stack every ink into one buffer, so we make one pass instead of a copy per ink
+    lines, arrays = zip(*pairs)
+    offsets = np.cumsum([len(a) for a in arrays])[:-1]
+    points = np.concatenate(arrays)
+    row_starts = np.zeros(len(points), dtype=np.bool_)
+    row_starts[0] = True
+    row_starts[offsets] = True
+
+    deltas = _to_deltas(points, row_starts)
+    return list(zip(lines, np.split(deltas, offsets)))
 
 
 class CTCLayer(layers.Layer):
@@ -521,10 +722,23 @@ def model_to_prediction_model(model):
     )
     return prediction_model
 
+def prediction_function(prediction_model):
+    """
+    Traces the prediction model once for any batch size and ink length,
+    so we can skip the per-call overhead of `predict`
+    """
+    step_size = prediction_model.inputs[0].shape[-1]
+
+    @tf.function(input_signature=[tf.TensorSpec([None, None, step_size], tf.float32)])
+    def predict(inks):
+        return prediction_model(inks, training=False)
+
+    return predict
+
 def save_prediction_model(model, path, steps=4000):
     run_model = tf.function(lambda x: model(x))
     concrete_func = run_model.get_concrete_function(
-        tf.TensorSpec([1, steps, 4], model.inputs[0].dtype)
+        tf.TensorSpec([1, steps, model.inputs[0].shape[-1]], model.inputs[0].dtype)
     )
     model.save(path, save_format="tf", signatures=concrete_func)
 
@@ -537,21 +751,22 @@ def test_keras(data_path, model_path, weights_only=True, checkpoint=None):
 
     test_count = 32
 
-    prediction_model = model_to_prediction_model(model)
+    predict = prediction_function(model_to_prediction_model(model))
 
     pairs = load_tensors(data_path)
+    test_size = len(pairs)
     validset = dataset_from_pairs(pairs)
 
     total_error = 0
-    for samples in validset.batch(test_count):
-        predictions = prediction_model.predict(samples["inks"])
+    for samples in validset.padded_batch(test_count):
+        predictions = predict(samples["inks"])
         predicted = ctc_decode(predictions, samples["ink_lengths"])
         for (true, _), pred in zip(pairs, predicted):
             e = cer(pred, true)
             total_error += e
             print(f"{true} -> {pred} [{e:.4}]")
         pairs = pairs[test_count:]
-    print(f"Mean CER: {total_error / float(len(validset))}")
+    print(f"Mean CER: {total_error / float(test_size)}")
 
 
 def test_tflite(tflite_path, test_file):
@@ -577,6 +792,10 @@ def test_tflite(tflite_path, test_file):
 
     interpreter.allocate_tensors()
 
+    # Reused for every sample, rather than allocating fresh arrays each time around the loop
+    input_buf = np.zeros((1, step_count, input_details[0]['shape'][2]), dtype=input_details[0]['dtype'])
+    length_buf = np.empty((1, 1), dtype='int64')
+
     for (line, points) in validset:
         if len(points) > step_count:
             # should truncate, but it's not working for some reason
@@ -585,18 +804,16 @@ def test_tflite(tflite_path, test_file):
         ink_length = len(points)
         before = time.monotonic()
         interpreter.reset_all_variables()
-        padding = step_count - points.shape[0]
-        if padding >= 0:
-            input_array = np.pad(points, ((0, padding), (0, 0)))
-        else:
-            input_array = points[:step_count, :]
+        input_buf[0, :ink_length] = points
+        input_buf[0, ink_length:] = 0.0
 
-        print(input_array.shape, points.shape, line)
-        interpreter.set_tensor(input_index, np.array([input_array]))
+        print(input_buf.shape[1:], points.shape, line)
+        interpreter.set_tensor(input_index, input_buf)
         interpreter.invoke()
 
         output_data = interpreter.get_tensor(output_index)
-        predicted = ctc_decode(tf.constant(output_data), np.array([[ink_length]]), beam_width=1)
+        length_buf[0, 0] = ink_length
+        predicted = ctc_decode(output_data, length_buf, beam_width=1)
         after = time.monotonic()
 
         my_cer = cer(predicted[0], line)
@@ -632,7 +849,7 @@ def validate(pairs):
             print(f"Bad line {i}: {','.join(errors)}. Text: `{line}`")
 
 
-def keras_to_tflite(model, checkpoint, tflite_path, dataset, weights_only, steps):
+def keras_to_tflite(model, checkpoint, tflite_path, dataset, weights_only, steps, quantize=False):
     model = load_model_and_checkpoint(model, checkpoint)
 
     prediction_model = model_to_prediction_model(model)
@@ -640,6 +857,23 @@ def keras_to_tflite(model, checkpoint, tflite_path, dataset, weights_only, steps
         save_prediction_model(prediction_model, tmp, steps)
         # prediction_model.save(tmp)
         converter = tf.lite.TFLiteConverter.from_saved_model(tmp)
+        if quantize:
+            # Quantize the weights to int8, which shrinks the model and lets the LSTMs use int8 kernels
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantize and dataset:
+            # With some sample inputs to calibrate against, quantize the activations too.
+            # Inputs and outputs stay float, since that's what the app feeds the model.
+            # Our datasets are concatenated source-by-source, so sample from the whole file.
+            pairs = load_tensors(dataset)
+            samples = random.sample(pairs, min(200, len(pairs)))
+
+            def representative_dataset():
+                for (_, points) in samples:
+                    points = points[:steps]
+                    padded = np.pad(points, ((0, steps - len(points)), (0, 0)))
+                    yield [np.array([padded], dtype='float32')]
+
+            converter.representative_dataset = representative_dataset
         # converter._experimental_lower_tensor_list_ops = False
         # converter.target_spec.supported_ops = [
         #     tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS
@@ -721,6 +955,18 @@ if __name__ == '__main__':
     subcommand.add_argument("to_path", type=str)
     subcommand.set_defaults(func=text_to_deltas)
 
+    def tensors_to_tfrecord(from_path, to_path):
+        pairs = load_tensors(from_path)
+        # Our tensor files are concatenated source-by-source, and training only shuffles within
+        # a small buffer, so mix the sources up before writing.
+        random.shuffle(pairs)
+        save_tfrecord(pairs, to_path)
+
+    subcommand = subparsers.add_parser("tensors_to_tfrecord")
+    subcommand.add_argument("from_path", type=str)
+    subcommand.add_argument("to_path", type=str)
+    subcommand.set_defaults(func=tensors_to_tfrecord)
+
     def do_train(root, trainset, validset, model, checkpoint):
         if root:
             trainset = os.path.join(root, "trainset.txt")
@@ -730,15 +976,8 @@ if __name__ == '__main__':
 
         model = load_model_and_checkpoint(model, checkpoint)
 
-        print("Fetching data...")
-        training_data = load_tensors(trainset)
-        validation_data = load_tensors(validset)
-
-        def dataset_from_pairs(pairs):
-            """
-            Accepts string->[N,4]d tensor pairs and returns a dataset
-            """
-            import random
+        def clean_pairs(pairs):
+            # The shuffle buffer is much smaller than the dataset, so mix the sources up front too
             random.shuffle(pairs)
 
             cleaned = []
@@ -747,31 +986,28 @@ if __name__ == '__main__':
                     cleaned.append((line, ink))
                 else:
                     print(f"OH NO: ink too short for input `{line}` (ink len {len(ink)})")
-            pairs = cleaned
+            return cleaned
 
-            lines_tensor = tf.ragged.constant([encode_string(p[0]) for p in pairs])
-            inks_tensor = tf.ragged.constant([p[1] for p in pairs], dtype=tf.float32)
-
-            def fit_batches(batch):
-                max_ink = tf.reduce_max(batch["ink_lengths"])
-                batch["inks"] = tf.slice(batch["inks"], [0, 0, 0], [-1, max_ink, -1])
-                max_ink = tf.reduce_max(batch["line_lengths"])
-                batch["lines"] = tf.slice(batch["lines"], [0, 0], [-1, max_ink])
-                return batch
+        def load_dataset(path, shuffle=False):
+            if path.endswith(".tfrecord"):
+                dataset = load_tfrecord(path) \
+                    .filter(lambda x: x["line_lengths"][0] * 2 <= x["ink_lengths"][0])
+            else:
+                print(f"Fetching {path}...")
+                pairs = load_tensors(path)
+                print(f"Building dataset from {path}...")
+                dataset = dataset_from_pairs(clean_pairs(pairs))
 
-            dataset = tf.data.Dataset.from_tensor_slices({
-                "lines": lines_tensor.to_tensor(),
-                "line_lengths": tf.reshape(lines_tensor.row_lengths(), (-1, 1)),
-                "inks": inks_tensor.to_tensor(),
-                "ink_lengths": tf.reshape(inks_tensor.row_lengths(), (-1, 1)),
-            })
+            # Cache the decoded samples, but before the shuffle so each epoch gets a new order
+            dataset = dataset.cache()
+            if shuffle:
+                dataset = dataset.shuffle(1000, reshuffle_each_iteration=True)
 
-            return dataset.batch(8).map(fit_batches)
+            # Only pad each batch out to its own longest sample
+            return dataset.padded_batch(8).prefetch(tf.data.AUTOTUNE)
 
-        print("Building trainset...")
-        trainset = dataset_from_pairs(training_data)
-        print("Building validset...")
-        validset = dataset_from_pairs(validation_data)
+        trainset = load_dataset(trainset, shuffle=True)
+        validset = load_dataset(validset)
 
         callbacks = [
             tf.keras.callbacks.ModelCheckpoint(
@@ -797,7 +1033,7 @@ if __name__ == '__main__':
         )
 
         model.fit(
-            trainset.shuffle(1000),
+            trainset,
             callbacks=callbacks,
             epochs=1000,
             validation_data=validset,
@@ -818,6 +1054,7 @@ if __name__ == '__main__':
     subcommand.add_argument("--dataset", type=str, default=None)
     subcommand.add_argument("--weights_only", default=False, action='store_true')
     subcommand.add_argument("--steps", type=int, default=1024)
+    subcommand.add_argument("--quantize", default=False, action='store_true')
     subcommand.set_defaults(func=keras_to_tflite)
 
     subcommand = subparsers.add_parser("test_keras")